@@ -1,7 +1,14 @@
 import requests
-import time
-import config
 import json
+import os
+from src.etl.consts import RATE_LIMIT
+from src.etl.scheduler import RequestScheduler, RateLimitError
+from src.etl.fixtures import FixtureRecorder, FixtureReplayer
+
+# Record live api traffic to a fixture archive, or replay it offline.
+# ETL_FIXTURE_MODE is unset (live), 'record' or 'replay'.
+FIXTURE_MODE = os.environ.get('ETL_FIXTURE_MODE')
+FIXTURE_PATH = os.environ.get('ETL_FIXTURE_PATH', 'etl_fixtures.fix')
 
 """
 REQUEST OAUTH TOKEN
@@ -13,6 +20,9 @@ def request_token():
     -------
     Temporary authorization token necessary to make API calls.
     """
+    # Only needed against the live service, so replay runs don't need config.py
+    import config
+
     # Set parameters for the POST request. Based on Spotify OAuth documentation.
     auth_url = 'https://accounts.spotify.com/api/token'
     auth_params = {'grant_type':'client_credentials'}
@@ -22,7 +32,7 @@ def request_token():
     auth_response = requests.post(url = auth_url, data = auth_params,headers=auth_header)
     return auth_response.json()['access_token']
 
-token = request_token()
+token = None if FIXTURE_MODE == 'replay' else request_token()
 
 """
 HELPERS FOR API CALL AND PARSING
@@ -69,7 +79,42 @@ def api_call(kind, token, params = None, id_ = None):
     # Set call authorization
     auth = {'Authorization':f'Bearer {token}'}
 
-    return requests.get(url, params = params, headers = auth).json()
+    response = requests.get(url, params = params, headers = auth)
+
+    # Let the scheduler back off when Spotify says we're going too fast
+    if response.status_code == 429:
+        retry_after = response.headers.get('Retry-After')
+        raise RateLimitError(float(retry_after) if retry_after else None)
+
+    return response.json()
+
+def fixture_api_call(token, mode = None, path = None):
+    """
+    RETURNS
+    -------
+    A function call(kind, params, id_) for RequestScheduler. Calls api_call
+    directly, or through a FixtureRecorder or FixtureReplayer depending on mode.
+
+    PARAMETERS
+    ----------
+    token: [str] the active OAuth token. Unused when replaying.
+
+    mode: [str] 'record' or 'replay'. Defaults to FIXTURE_MODE, where None
+        means live calls.
+
+    path: [str] fixture archive to write or read. Defaults to FIXTURE_PATH.
+    """
+    mode = mode or FIXTURE_MODE
+    path = path or FIXTURE_PATH
+
+    def call(kind, params, id_):
+        return api_call(kind, token, params = params, id_ = id_)
+
+    if mode == 'record':
+        return FixtureRecorder(call, path)
+    if mode == 'replay':
+        return FixtureReplayer(path)
+    return call
 
 def parse_search(search_results):
     """
@@ -138,7 +183,7 @@ API CALLS AND PARSING
 5. Maybe MySQL tables? Then can combine necessary things when you want?
 """
 """
-1. Start with artist names to get Spotify artist IDs
+1. - 4. Crawl from artist names to track data through the scheduler
 """
 # Pick artists whose music we'll explore. 4 Salsa, 4 Bachata.
 artists = {
@@ -146,28 +191,17 @@ artists = {
     'bachata':["Aventura", "Monchy & Alexandra", "Prince Royce", "Romeo Santos"]
 }
 
-def get_artist_ids(artists, token):
+def crawl_track_data(artists, token, scheduler=None, report=None):
     """
     RETURNS
     -------
-    A dict with artist ids separated into respective genres. Example:
-        {
-            'genre_1':{
-                'artist_1': 'artist id',
-                'artist_2': 'artist id',
-                etc.
-            },
-            'genre_2':{
-                'artist_1': 'artist id',
-                'artist_2': 'artist id',
-                etc.
-            },
-            etc.
-        }
+    A list of dicts, one per track, combining parsed features, parsed track
+    info, analysis sections and genre.
+    Tracks with a failed call are left out. See scheduler.errors for them.
 
     PARAMETERS
     ----------
-    artsits: [dict] contains genre and artist information in the form:
+    artists: [dict] contains genre and artist information in the form:
         {
             'genre_1':[artist names],
             'genre_2':[artist names],
@@ -176,15 +210,75 @@ def get_artist_ids(artists, token):
 
     token: [str] The temporary OAuth token obtained from request_token()
 
-    """
-
-
-    # Container to store artist ids. Depends on number of genres in `artists`
-    artist_ids = {genre:{} for genre in artists.keys()}
+    scheduler: [RequestScheduler] optional. Defaults to one with the global
+        rate budget from src/etl/consts.py (no limit when replaying),
+        calling the api through fixture_api_call(). Discovery calls (search,
+        albums, album_tracks) run before per-track calls, and the heavy
+        analysis calls fill in the budget whenever nothing else is waiting.
 
-    # Iterate through each genre and then through each artist name
-    for genre, artists in artists.items():
-        for artist in artists:
+    report: [function] optional, called with the scheduler's queue depths
+        as the crawl progresses, e.g. print.
+    """
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        call = fixture_api_call(token)
+
+        # A replay is limited only by the replayer's simulated latency, so
+        # throughput tests measure the pipeline rather than RATE_LIMIT
+        rate = None if isinstance(call, FixtureReplayer) else RATE_LIMIT
+        scheduler = RequestScheduler(call, rate = rate)
+
+    # Rows being filled in, keyed by track id
+    rows = {}
+
+    def checked(results):
+        # Spotify answers 401/404 with an error body instead of results
+        if 'error' in results:
+            raise ValueError(results['error'])
+        return results
+
+    def on_track_result(track_id, parse):
+        def callback(results):
+            rows[track_id].update(parse(checked(results)))
+        return callback
+
+    def on_album_tracks(genre):
+        def callback(tracks):
+            for track in checked(tracks)['items']:
+
+                # Only new tracks need the (expensive) per-track calls
+                if track['id'] in rows:
+                    continue
+                rows[track['id']] = {'genre':genre}
+
+                scheduler.submit('features', id_=track['id'],
+                                 callback=on_track_result(track['id'], parse_features))
+                scheduler.submit('tracks', id_=track['id'],
+                                 callback=on_track_result(track['id'], parse_tracks))
+                scheduler.submit('analysis', id_=track['id'],
+                                 callback=on_track_result(
+                                     track['id'], lambda results: {'sections':results['sections']}))
+        return callback
+
+    def on_albums(genre, artist):
+        def callback(albums):
+            # Filter out albums that are not entirely their own by restricting
+            # the album artist name to be only the name of the current artist
+            for album in checked(albums)['items']:
+                if album['artists'][0]['name'] == artist:
+                    scheduler.submit('album_tracks', id_=album['id'],
+                                     callback=on_album_tracks(genre))
+        return callback
+
+    def on_search(genre, artist):
+        def callback(search_results):
+            # Capture up to 20 albums by the artist
+            scheduler.submit('albums', params={'limit':20}, id_=parse_search(checked(search_results)),
+                             callback=on_albums(genre, artist))
+        return callback
+
+    for genre, names in artists.items():
+        for artist in names:
 
             # Set search params.
             params = {
@@ -193,152 +287,15 @@ def get_artist_ids(artists, token):
                   'limit':None,      # No. of responses: [int] default is 20. Can be (1, 50)
                   'offset':None      # Index of where to start in the search results. Can be (1, 100,000)
             }
-
-            # Make API call and then parse to append id to artist_ids
-            search_results = api_call('search', token, params)
-            artist_ids[genre][artist] = parse_search(search_results)
-
-    return artist_ids
-
-"""
-2. Using artist IDs, get up to 50 album IDs per artist
-"""
-
-def get_album_ids(artist_ids, token):
-    """
-    RETURNS
-    -------
-    A dict with artists' album ids separated into respective genres. Example:
-        {
-            'genre_1':{
-                'artist_1': [album ids],
-                'artist_2': [album ids],
-                etc.
-            },
-            'genre_2': {
-                'artist_1': [album ids],
-                'artist_2': [album ids],
-                etc.
-            etc.
-            }
-        }
-
-    PARAMETERS
-    ----------
-    artsits: [dict] contains genre and artist information in the form:
-        {
-            'genre_1':[artist names],
-            'genre_2':[artist names],
-            etc.
-        }
-
-    token: [str] The temporary OAuth token obtained from request_token()
-
-    """
-
-    # Container to store album ids. Depends on number of genres in `artist_ids`
-    artist_album_ids = {genre:{} for genre in artist_ids.keys()}
-
-    for genre, artists in artist_ids.items():
-        for artist in artists:
-
-            # Capture up to 50 albums by current artist in the loop
-            params={'limit':20}
-
-            # Make API call using artist ID of the current artist in the loop
-            albums = api_call('albums', token, params=params, id_=artist_ids[genre][artist])
-
-            # Generate list of the album ids for the current artist in the loop. Filter out albums
-            # That are not entirely their own by restricting the album artist name to be only the name
-            # of the current artist in the loop
-            album_ids = [album['id']
-                         for album in albums['items']
-                         if album['artists'][0]['name'] == artist]
-
-            # Add this list to a dict
-            artist_album_ids[genre][artist] = album_ids
-
-            # Wait a little bit to not get kicked off API
-            time.sleep(0.25)
-
-    return artist_album_ids
-
-
-# """
-# 3. Pass Album IDs into album_tracks call to get each individual track's info
-# """
-#
-# # Partition artist list into salseros and bachateros so that
-# # we can easily label genres later
-# salseros = artists[:4]
-# bachateros = artists[4:]
-#
-# # Set up track ID containers
-# salsa_track_ids = []
-# bachata_track_ids = []
-#
-# # Iterate through dict to get an individual artist
-# for artist in artists_album_ids:
-#
-#     # Iterate through each artist's album ids
-#     for album_id in artists_album_ids[artist]:
-#
-#         # Call API for album track info
-#         tracks = api_call('album_tracks', token, id_=album_id)
-#
-#         # Iterate through each album's track's info
-#         for track in tracks['items']:
-#
-#             # Extract song ids and sort into appropriate container
-#             if artist in salseros:
-#                 salsa_track_ids.append(track['id'])
-#             else:
-#                 bachata_track_ids.append(track['id'])
-#
-#         # Wait a moment
-#         time.sleep(0.1)
-#
-# """
-# 4. Pass track ids into analysis, features, and track info calls
-# """
-# def collect_data(track_ids,genre):
-#     """
-#     Returns a list of song data for each id passed into the function.
-#     Param track_ids: [list of strings] must be valid Spotify song IDs.
-#     Param genre: [str] must be either 'salsa' or 'bachata'
-#     """
-#     assert type(track_ids) == list, 'The argument passed as track_ids is not a list'
-#     assert genre in ['salsa','bachata'], 'Pick a valid genre'
-#
-#     # Container for song data
-#     result = []
-#
-#     # Iterate through track id list
-#     for track_id in track_ids:
-#
-# #         print('start of the loop')
-# #         print(f'track id is {track_id}')
-#
-#         # Call API for section data. See documentation for meanings
-#         analysis_sections = {'sections':api_call('analysis', token, id_=track_id)['sections']}
-#
-#         # Call API for audio features and parse for relevant information
-#         parsed_features = parse_features(api_call('features', token, id_=track_id))
-#
-#         # Call API for track info and parse for relevant information
-#         parsed_track_info = parse_tracks(api_call('tracks', token, id_=track_id))
-#
-#
-#         # Combine all these calls into a single dict, adding in genre
-#         row = {**parsed_features, **parsed_track_info, **analysis_sections,'genre':genre}
-#
-#         # Append to container
-#         result.append(row)
-#
-#         time.sleep(0.1)
-#
-#     return result
-#
-# salsa_track_data = collect_data(salsa_track_ids,'salsa')
-# bachata_track_data = collect_data(bachata_track_ids,'bachata')
-# all_track_data = salsa_track_data + bachata_track_data
+            scheduler.submit('search', params=params, callback=on_search(genre, artist))
+
+    try:
+        scheduler.run(report=report)
+    finally:
+        # Write the fixture index now rather than at exit, or release the
+        # replayed archive
+        if own_scheduler and isinstance(scheduler.call, (FixtureRecorder, FixtureReplayer)):
+            scheduler.call.close()
+
+    failed = {error[2] for error in scheduler.errors}
+    return [row for track_id, row in rows.items() if track_id not in failed]
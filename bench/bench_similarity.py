@@ -0,0 +1,88 @@
+"""
+Query latency of SimilarityIndex on synthetic catalogues.
+
+Run from the repo root:
+
+    python -m bench.bench_similarity [--sizes 10000 100000 1000000]
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+from src.analysis.consts import PREDICTORS
+from src.analysis.similarity import SimilarityIndex
+
+def synthetic_tracks(n_tracks, random_state=1):
+    """
+    Returns
+    -------
+    (n_tracks, len(PREDICTORS)) matrix of feature values with roughly the
+    spread of the real Spotify features.
+    """
+    rng = np.random.RandomState(random_state)
+    scales = rng.uniform(0.1, 100, size=len(PREDICTORS))
+    return rng.normal(size=(n_tracks, len(PREDICTORS))) * scales
+
+def time_queries(index, queries, query_ids, k, repeats):
+    """
+    Returns
+    -------
+    A tuple (single query latency in ms, single query_ids() latency in ms,
+    batched throughput in queries/sec).
+    """
+    start = time.perf_counter()
+    for query in queries[:repeats]:
+        index.query(query, k)
+    single_ms = (time.perf_counter() - start) / repeats * 1000
+
+    # The first lookup sorts the ids once, keep that out of the timing
+    index.query_ids(query_ids[0], k)
+    start = time.perf_counter()
+    for id_ in query_ids[:repeats]:
+        index.query_ids(id_, k)
+    ids_ms = (time.perf_counter() - start) / repeats * 1000
+
+    start = time.perf_counter()
+    index.query(queries, k)
+    batch_qps = len(queries) / (time.perf_counter() - start)
+
+    return single_ms, ids_ms, batch_qps
+
+def main(sizes, n_queries, k, repeats):
+    print('{:>9} {:>12} {:>9} {:>11} {:>11} {:>12} {:>8}'.format(
+        'tracks', 'mode', 'build s', 'single ms', 'by id ms', 'batch q/s', 'recall'))
+
+    for n_tracks in sizes:
+        X = synthetic_tracks(n_tracks)
+        query_ids = np.random.RandomState(2).choice(n_tracks, n_queries, replace=False)
+        queries = X[query_ids]
+        truth = None
+
+        for mode in ['exact', 'partitioned']:
+            start = time.perf_counter()
+            index = SimilarityIndex(mode).fit(X)
+            build_s = time.perf_counter() - start
+
+            # Query a memory-mapped copy, as a saved catalogue would be served
+            with tempfile.TemporaryDirectory() as path:
+                index.save(path)
+                index = SimilarityIndex.load(path)
+                single_ms, ids_ms, batch_qps = time_queries(index, queries, query_ids, k, repeats)
+                found, _ = index.query(queries, k)
+
+            if truth is None:
+                truth = found
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+            print('{:>9} {:>12} {:>9.2f} {:>11.3f} {:>11.3f} {:>12.0f} {:>8.3f}'.format(
+                n_tracks, mode, build_s, single_ms, ids_ms, batch_qps, recall))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+    main(args.sizes, args.queries, args.k, args.repeats)
@@ -12,6 +12,7 @@ setup(
         "numpy==1.18.2",
         "pandas==0.25.3",
         "pytest==5.3.2",
+        "requests==2.23.0",
         "spotipy==2.11.2",
     ],
 )
\ No newline at end of file
@@ -0,0 +1,18 @@
+# Audio features used as predictors in mod_5_notebook.ipynb, minus the two
+# engineered section features
+PREDICTORS = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness',
+              'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo',
+              'duration_ms']
+
+# Search modes supported by SimilarityIndex
+MODES = ['exact', 'partitioned']
+
+# k-means settings for building partitions
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 50000
+
+# File holding index settings next to the saved arrays
+META_FILE = 'meta.json'
+
+# Largest number of query x track distances computed at once
+MAX_DISTANCE_BLOCK = 2 ** 24
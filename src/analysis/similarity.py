@@ -0,0 +1,445 @@
+import json
+import os
+
+import numpy as np
+from .consts import *
+
+class SimilarityIndex:
+    """
+    Nearest-neighbour index over standardized track feature vectors.
+
+    Two search modes are supported:
+
+    'exact': brute-force squared euclidean distances computed in batches as
+        |q|^2 - 2 q.x + |x|^2, so the heavy lifting is a single BLAS matrix
+        product per batch.
+
+    'partitioned': tracks are grouped into `n_partitions` clusters with a few
+        rounds of k-means. A query only scans the `n_probe` partitions whose
+        centroids are closest, trading a little recall for much less work on
+        large catalogues.
+    """
+
+    def __init__(self, mode='exact', n_partitions=None, n_probe=8,
+                 batch_size=1024, random_state=1):
+        """
+        Parameters
+        ----------
+        mode: [str] either 'exact' or 'partitioned'.
+
+        n_partitions: [int] number of clusters used in 'partitioned' mode.
+            Defaults to roughly sqrt(n_tracks) when the index is built.
+
+        n_probe: [int] number of partitions scanned per query in 'partitioned'
+            mode.
+
+        batch_size: [int] number of queries whose distances are computed at once.
+
+        random_state: [int] seed for the k-means initialization.
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}. Use one of {}.".format(mode, MODES))
+
+        self.mode = mode
+        self.n_partitions = n_partitions
+        self.n_probe = n_probe
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+        self.features = None
+        self.ids = None
+        self.mean_ = None
+        self.scale_ = None
+        self.vectors_ = None
+        self.sq_norms_ = None
+        self.centroids_ = None
+        self.offsets_ = None
+        self._id_order = None
+        self._sorted_ids = None
+
+    def fit(self, X, ids=None, features=None):
+        """
+        Standardizes the feature matrix and builds the index.
+
+        Returns
+        -------
+        The fitted SimilarityIndex.
+
+        Parameters
+        ----------
+        X: [array-like] (n_tracks, n_features) matrix of raw feature values.
+
+        ids: [array-like] optional track ids, one per row of X. Defaults to
+            the row positions.
+
+        features: [list] optional feature names matching the columns of X.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or len(X) == 0:
+            raise ValueError('X must be a non-empty 2D array of feature values.')
+
+        ids = np.arange(len(X)) if ids is None else np.asarray(ids)
+        if len(ids) != len(X):
+            raise ValueError('ids must have one entry per row of X.')
+
+        # Spotify ids from a DataFrame come in as objects, which np.save can't
+        # write without pickling
+        if ids.dtype == object:
+            ids = ids.astype(str)
+
+        self.features = list(features) if features is not None else None
+
+        # Standardize each feature so that tempo and duration_ms don't drown
+        # out the features that live in [0, 1]
+        self.mean_ = X.mean(axis=0)
+        scale = X.std(axis=0)
+        scale[scale == 0] = 1.0
+        self.scale_ = scale
+        vectors = ((X - self.mean_) / self.scale_).astype(np.float32)
+
+        if self.mode == 'partitioned':
+            n_partitions = self.n_partitions or max(1, int(np.sqrt(len(X))))
+            n_partitions = min(n_partitions, len(X))
+            centroids, labels = _kmeans(vectors, n_partitions, self.random_state)
+
+            # Store rows contiguously by partition so each one is a slice
+            order = np.argsort(labels, kind='stable')
+            counts = np.bincount(labels, minlength=n_partitions)
+            self.centroids_ = centroids
+            self.offsets_ = np.concatenate([[0], np.cumsum(counts)])
+            vectors = vectors[order]
+            ids = ids[order]
+
+        self.vectors_ = vectors
+        self.sq_norms_ = np.einsum('ij,ij->i', vectors, vectors)
+        self.ids = ids
+        self._id_order = None
+        self._sorted_ids = None
+        return self
+
+    @classmethod
+    def from_dataframe(cls, df, features=PREDICTORS, id_col=None, **kwargs):
+        """
+        Builds an index from a DataFrame of track data, e.g. the notebook's `df`.
+
+        Returns
+        -------
+        A fitted SimilarityIndex.
+
+        Parameters
+        ----------
+        df: [pandas.DataFrame] one row per track.
+
+        features: [list] columns used as the feature vector.
+
+        id_col: [str] optional column holding track ids. Defaults to df.index.
+
+        kwargs: passed on to SimilarityIndex().
+        """
+        ids = df.index.values if id_col is None else df[id_col].values
+        return cls(**kwargs).fit(df.loc[:, features].values, ids, features)
+
+    def transform(self, X):
+        """
+        Returns
+        -------
+        X standardized with the statistics learned in fit(), as float32.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        return ((X - self.mean_) / self.scale_).astype(np.float32)
+
+    def query(self, X, k=5):
+        """
+        Finds the k nearest tracks to each row of X.
+
+        Returns
+        -------
+        A tuple (ids, distances), each of shape (n_queries, k), sorted from
+        nearest to farthest. Distances are euclidean in standardized units.
+        When fewer than k tracks are scanned the remaining slots hold a
+        distance of inf and a missing id: -1 for numeric ids, '' for string ids.
+
+        Parameters
+        ----------
+        X: [array-like] (n_queries, n_features) raw feature values, or a
+            single vector.
+
+        k: [int] number of neighbours to return per query.
+        """
+        if self.vectors_ is None:
+            raise ValueError('The index is empty. Call fit() or load() first.')
+
+        rows, dists = self._query_rows(self.transform(X), k)
+        return self._ids_at(rows), np.sqrt(dists)
+
+    def query_ids(self, ids, k=5):
+        """
+        Finds the k nearest neighbours of tracks already in the index, leaving
+        each track itself out of its own results.
+
+        Returns
+        -------
+        A tuple (ids, distances) as in query().
+
+        Parameters
+        ----------
+        ids: [array-like] track ids that were passed to fit().
+
+        k: [int] number of neighbours to return per track.
+        """
+        if self.vectors_ is None:
+            raise ValueError('The index is empty. Call fit() or load() first.')
+
+        rows = self._rows_of(ids)
+        found, dists = self._query_rows(self.vectors_[rows], k + 1)
+
+        # Drop the query track itself by row. When ties pushed it out of the
+        # results, drop the farthest neighbour instead so every row keeps k.
+        keep = found != rows[:, None]
+        missing_self = keep.all(axis=1)
+        keep[missing_self, -1] = False
+        shape = (len(rows), found.shape[1] - 1)
+        found = found[keep].reshape(shape)
+        dists = dists[keep].reshape(shape)
+
+        return self._ids_at(found), np.sqrt(dists)
+
+    def _rows_of(self, ids):
+        """
+        Returns
+        -------
+        The row of each id in `ids`. Raises ValueError for ids not in the index.
+        """
+        # Sorting the ids once keeps repeated lookups at O(log n) each
+        if self._id_order is None:
+            self._id_order = np.argsort(self.ids, kind='stable')
+            self._sorted_ids = self.ids[self._id_order]
+
+        ids = np.atleast_1d(np.asarray(ids))
+        if ids.dtype == object:
+            ids = ids.astype(str)
+
+        sorted_ids = self._sorted_ids
+        positions = np.clip(np.searchsorted(sorted_ids, ids), 0, len(self.ids) - 1)
+        found = sorted_ids[positions] == ids
+        if not found.all():
+            raise ValueError('Ids not in the index: {}'.format(ids[~found].tolist()))
+
+        return self._id_order[positions]
+
+    def _query_rows(self, queries, k):
+        """
+        Returns
+        -------
+        A tuple (rows, squared distances) of the k nearest rows to each
+        standardized query. Unfilled slots hold row -1 and distance inf.
+        """
+        k = min(k, len(self.vectors_))
+
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        dists = np.empty((len(queries), k), dtype=np.float32)
+
+        # Cap the size of each distance matrix so 1M-track catalogues fit in memory
+        step = max(1, min(self.batch_size, MAX_DISTANCE_BLOCK // len(self.vectors_)))
+
+        for start in range(0, len(queries), step):
+            batch = queries[start:start + step]
+            if self.mode == 'exact':
+                batch_rows, batch_dists = self._search_exact(batch, k)
+            else:
+                batch_rows, batch_dists = self._search_partitioned(batch, k)
+            rows[start:start + len(batch)] = batch_rows
+            dists[start:start + len(batch)] = batch_dists
+
+        return rows, dists
+
+    def _ids_at(self, rows):
+        """
+        Returns
+        -------
+        The ids at `rows`, with the missing id wherever a row is -1.
+        """
+        ids = self.ids[np.clip(rows, 0, None)]
+        ids[rows < 0] = '' if self.ids.dtype.kind in 'US' else -1
+        return ids
+
+    def _search_exact(self, batch, k):
+        """
+        Brute-force search of a batch of standardized queries over every row.
+        """
+        return _top_k(_sq_distances(batch, self.vectors_, self.sq_norms_), k)
+
+    def _search_partitioned(self, batch, k):
+        """
+        Search of a batch of standardized queries over the `n_probe` nearest
+        partitions of each query.
+        """
+        n_probe = min(self.n_probe, len(self.centroids_))
+        centroid_norms = np.einsum('ij,ij->i', self.centroids_, self.centroids_)
+        probes = _top_k(_sq_distances(batch, self.centroids_, centroid_norms), n_probe)[0]
+
+        rows = np.full((len(batch), k), -1, dtype=np.int64)
+        dists = np.full((len(batch), k), np.inf, dtype=np.float32)
+
+        for i, query in enumerate(batch):
+            candidates = np.concatenate([
+                np.arange(self.offsets_[p], self.offsets_[p + 1]) for p in probes[i]
+            ])
+            d = _sq_distances(query[None, :], self.vectors_[candidates],
+                              self.sq_norms_[candidates])[0]
+            n = min(k, len(candidates))
+            best, best_d = _top_k(d[None, :], n)
+            rows[i, :n] = candidates[best[0]]
+            dists[i, :n] = best_d[0]
+
+        return rows, dists
+
+    def save(self, path):
+        """
+        Writes the index to the directory `path`. Arrays are stored as .npy
+        files so that load() can memory-map them.
+        """
+        if self.vectors_ is None:
+            raise ValueError('The index is empty. Call fit() before save().')
+
+        os.makedirs(path, exist_ok=True)
+
+        meta = {
+            'mode': self.mode,
+            'n_partitions': self.n_partitions,
+            'n_probe': self.n_probe,
+            'batch_size': self.batch_size,
+            'random_state': self.random_state,
+            'features': self.features,
+        }
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        arrays = {
+            'ids': self.ids,
+            'mean': self.mean_,
+            'scale': self.scale_,
+            'vectors': self.vectors_,
+            'sq_norms': self.sq_norms_,
+        }
+        if self.mode == 'partitioned':
+            arrays['centroids'] = self.centroids_
+            arrays['offsets'] = self.offsets_
+
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Reads an index written by save().
+
+        Returns
+        -------
+        A fitted SimilarityIndex.
+
+        Parameters
+        ----------
+        path: [str] directory passed to save().
+
+        mmap: [bool] if True the track vectors are memory-mapped read-only
+            instead of being read into memory.
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+
+        features = meta.pop('features')
+        index = cls(**meta)
+        index.features = features
+
+        def read(name, mmap_mode=None):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+        mmap_mode = 'r' if mmap else None
+        index.ids = read('ids')
+        index.mean_ = read('mean')
+        index.scale_ = read('scale')
+        index.vectors_ = read('vectors', mmap_mode)
+        index.sq_norms_ = read('sq_norms', mmap_mode)
+        if index.mode == 'partitioned':
+            index.centroids_ = read('centroids')
+            index.offsets_ = read('offsets')
+
+        return index
+
+    def __len__(self):
+        return 0 if self.vectors_ is None else len(self.vectors_)
+
+def _sq_distances(queries, vectors, sq_norms):
+    """
+    Returns
+    -------
+    (n_queries, n_vectors) matrix of squared euclidean distances.
+    """
+    q_norms = np.einsum('ij,ij->i', queries, queries)
+    d = queries @ vectors.T
+    d *= -2
+    d += q_norms[:, None]
+    d += sq_norms[None, :]
+
+    # Rounding in the expansion can leave tiny negative values
+    np.maximum(d, 0, out=d)
+    return d
+
+def _top_k(d, k):
+    """
+    Returns
+    -------
+    A tuple (columns, values) holding the k smallest values of each row of d,
+    sorted ascending.
+    """
+    if k < d.shape[1]:
+        part = np.argpartition(d, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+    values = np.take_along_axis(d, part, axis=1)
+    order = np.argsort(values, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+def _kmeans(X, n_clusters, random_state, n_iter=KMEANS_ITERATIONS,
+            sample_size=KMEANS_SAMPLE_SIZE):
+    """
+    Lloyd's k-means on a sample of X, followed by a full assignment pass.
+
+    Returns
+    -------
+    A tuple (centroids, labels) with one label per row of X.
+    """
+    rng = np.random.RandomState(random_state)
+
+    if len(X) > sample_size:
+        sample = X[rng.choice(len(X), sample_size, replace=False)]
+    else:
+        sample = X
+    n_clusters = min(n_clusters, len(sample))
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = _assign(sample, centroids)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.stack([np.bincount(labels, weights=column, minlength=n_clusters)
+                         for column in sample.T], axis=1)
+
+        # Keep the old centroid for clusters that lost all their points
+        filled = counts > 0
+        centroids[filled] = (sums[filled] / counts[filled, None]).astype(centroids.dtype)
+
+    return centroids, _assign(X, centroids)
+
+def _assign(X, centroids, batch_size=65536):
+    """
+    Returns
+    -------
+    The index of the nearest centroid for each row of X.
+    """
+    norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(X), dtype=np.int64)
+    for start in range(0, len(X), batch_size):
+        d = _sq_distances(X[start:start + batch_size], centroids, norms)
+        labels[start:start + batch_size] = d.argmin(axis=1)
+    return labels
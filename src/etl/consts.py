@@ -1,2 +1,36 @@
 artist = 'Drake'
 
+# Global request budget shared by every api_call kind, in cost units per second
+RATE_LIMIT = 10
+
+# Number of api calls the scheduler keeps in flight at once
+WORKERS = 4
+
+# Fallback pause in seconds when a 429 response has no Retry-After header
+DEFAULT_RETRY_AFTER = 1
+
+# Times a rate limited request is retried before it is recorded as failed
+MAX_RETRIES = 5
+
+# Scheduling settings for each api_call kind. Lower priority values are
+# dispatched first. Weight splits the budget between kinds that share a
+# priority, and cost is what one call takes from the global budget.
+# Discovery calls grow the crawl frontier and go first; analysis is heavy and
+# only runs when no discovery or feature calls are waiting.
+QUEUE_SETTINGS = {
+    'search':          {'priority': 0, 'weight': 1, 'cost': 1},
+    'artist':          {'priority': 0, 'weight': 1, 'cost': 1},
+    'albums':          {'priority': 0, 'weight': 2, 'cost': 1},
+    'multiple_albums': {'priority': 0, 'weight': 2, 'cost': 1},
+    'album_tracks':    {'priority': 0, 'weight': 4, 'cost': 1},
+    'tracks':          {'priority': 1, 'weight': 1, 'cost': 1},
+    'features':        {'priority': 1, 'weight': 1, 'cost': 1},
+    'analysis':        {'priority': 2, 'weight': 1, 'cost': 3},
+}
+
+# Fixture archive layout, see fixtures.py. Each index entry is
+# (request hash, data offset, data length), the footer is
+# (index offset, entry count, magic).
+FIXTURE_MAGIC = b'ETLFIX01'
+FIXTURE_ENTRY = '<QQI'
+FIXTURE_FOOTER = '<QQ8s'
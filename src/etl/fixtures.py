@@ -0,0 +1,245 @@
+import atexit
+import collections
+import bisect
+import hashlib
+import json
+import mmap
+import random
+import struct
+import threading
+import time
+import zlib
+from .consts import *
+from .scheduler import RateLimitError
+
+ENTRY_SIZE = struct.calcsize(FIXTURE_ENTRY)
+FOOTER_SIZE = struct.calcsize(FIXTURE_FOOTER)
+
+class FixtureMissError(KeyError):
+    """
+    Raised in replay mode for a request that isn't in the archive.
+    """
+
+def request_key(kind, params=None, id_=None):
+    """
+    Returns
+    -------
+    A canonical string for an api call, equal for equal requests regardless
+    of the order of `params`.
+    """
+    return json.dumps([kind, params, id_], sort_keys=True, separators=(',', ':'))
+
+def request_hash(key):
+    """
+    Returns
+    -------
+    The 64-bit integer under which `key` is stored in the archive index.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+class FixtureRecorder:
+    """
+    Wraps an api call and saves every request/response pair to a fixture
+    archive at `path`.
+
+    The archive is a single file: each response is zlib-compressed JSON
+    appended as it arrives, then close() writes an index sorted by request
+    hash and a footer pointing at it. Recording the same request twice keeps
+    the latest response.
+    """
+
+    def __init__(self, call, path, level=6):
+        """
+        Parameters
+        ----------
+        call: [function] called as call(kind, params, id_), e.g. ETL.api_call
+            with the token bound.
+
+        path: [str] archive file to write. Overwritten if it exists.
+
+        level: [int] zlib compression level.
+        """
+        self.call = call
+        self.path = path
+        self.level = level
+        self.file = open(path, 'wb')
+        self.file.write(FIXTURE_MAGIC)
+        self.entries = {}
+
+        # The scheduler records from its worker threads
+        self.lock = threading.Lock()
+
+        # ETL.py runs as a script, so make sure the index gets written
+        atexit.register(self.close)
+
+    def __call__(self, kind, params=None, id_=None):
+        result = self.call(kind, params, id_)
+        self.add(kind, params, id_, result)
+        return result
+
+    def add(self, kind, params, id_, result):
+        """
+        Stores `result` as the response to the given request.
+        """
+        key = request_key(kind, params, id_)
+        blob = zlib.compress(json.dumps([key, result], separators=(',', ':')).encode(),
+                             self.level)
+        with self.lock:
+            self.entries[request_hash(key)] = (self.file.tell(), len(blob))
+            self.file.write(blob)
+
+    def close(self):
+        """
+        Writes the index and footer. Safe to call more than once.
+        """
+        with self.lock:
+            if self.file.closed:
+                return
+
+            index_offset = self.file.tell()
+            for hash_ in sorted(self.entries):
+                self.file.write(struct.pack(FIXTURE_ENTRY, hash_, *self.entries[hash_]))
+            self.file.write(struct.pack(FIXTURE_FOOTER, index_offset, len(self.entries),
+                                        FIXTURE_MAGIC))
+            self.file.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FixtureReplayer:
+    """
+    Serves api call results from a fixture archive written by FixtureRecorder.
+    Works as a drop-in `call` for RequestScheduler.
+
+    The archive is memory-mapped and requests are found by binary search over
+    the sorted hash index, so only the pages that are touched get read.
+    Simulated latency and errors are drawn from a generator seeded by the
+    request itself and how often it was asked for. A replay is therefore
+    deterministic even when the scheduler runs calls on several threads.
+    """
+
+    def __init__(self, path, latency=0, jitter=0, error_rate=0,
+                 retry_after=DEFAULT_RETRY_AFTER, seed=1, sleep=time.sleep):
+        """
+        Parameters
+        ----------
+        path: [str] archive written by FixtureRecorder.
+
+        latency: [float] seconds to sleep before every response.
+
+        jitter: [float] extra random sleep of up to this many seconds.
+
+        error_rate: [float] chance in [0, 1] that a call raises RateLimitError
+            instead of answering.
+
+        retry_after: [float] Retry-After given with simulated errors.
+
+        seed: [int] seed mixed into each request's latency and error draws.
+
+        sleep: [function] sleep function. Replaceable for tests.
+        """
+        self.path = path
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.sleep = sleep
+
+        # Times each request key has been asked for, guarded for worker threads
+        self.attempts = collections.Counter()
+        self.lock = threading.Lock()
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        index_offset, self.count, magic = struct.unpack_from(
+            FIXTURE_FOOTER, self.map, len(self.map) - FOOTER_SIZE)
+        if magic != FIXTURE_MAGIC or self.map[:len(FIXTURE_MAGIC)] != FIXTURE_MAGIC:
+            self.map.close()
+            raise ValueError('{} is not a fixture archive.'.format(path))
+        self.index_offset = index_offset
+
+    def __call__(self, kind, params=None, id_=None):
+        key = request_key(kind, params, id_)
+        with self.lock:
+            attempt = self.attempts[key]
+            self.attempts[key] += 1
+        rng = random.Random(((request_hash(key) ^ self.seed) << 16) + attempt)
+
+        if self.latency or self.jitter:
+            self.sleep(self.latency + rng.uniform(0, self.jitter))
+
+        if self.error_rate and rng.random() < self.error_rate:
+            raise RateLimitError(self.retry_after)
+
+        return self.get(kind, params, id_)
+
+    def get(self, kind, params=None, id_=None):
+        """
+        Returns
+        -------
+        The recorded response to the request, without simulated latency or
+        errors. Raises FixtureMissError if it was never recorded.
+        """
+        key = request_key(kind, params, id_)
+        position = self._find(request_hash(key))
+        if position is not None:
+            _, offset, length = self._entry(position)
+            stored_key, result = json.loads(zlib.decompress(self.map[offset:offset + length]))
+
+            # Guard against the (unlikely) case of two keys sharing a hash
+            if stored_key == key:
+                return result
+
+        raise FixtureMissError(key)
+
+    def __contains__(self, request):
+        """
+        `request` is a (kind, params, id_) tuple.
+        """
+        try:
+            self.get(*request)
+        except FixtureMissError:
+            return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _entry(self, position):
+        return struct.unpack_from(FIXTURE_ENTRY, self.map,
+                                  self.index_offset + position * ENTRY_SIZE)
+
+    def _find(self, hash_):
+        hashes = _IndexHashes(self)
+        position = bisect.bisect_left(hashes, hash_)
+        if position < self.count and hashes[position] == hash_:
+            return position
+        return None
+
+class _IndexHashes:
+    """
+    Read-only sequence view of the hashes in an archive index, for bisect.
+    """
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def __len__(self):
+        return self.replayer.count
+
+    def __getitem__(self, position):
+        return self.replayer._entry(position)[0]
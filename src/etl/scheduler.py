@@ -0,0 +1,297 @@
+import collections
+import concurrent.futures
+import time
+from .consts import *
+
+class RateLimitError(Exception):
+    """
+    Raised by an api call when Spotify answers 429 Too Many Requests.
+    """
+    def __init__(self, retry_after=None):
+        self.retry_after = DEFAULT_RETRY_AFTER if retry_after is None else retry_after
+        super().__init__('Rate limited. Retry after {}s.'.format(self.retry_after))
+
+class TokenBucket:
+    """
+    Global request budget. Holds up to `capacity` tokens and refills at `rate`
+    tokens per second. A rate of None means unbounded, only pauses apply.
+    """
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.paused_until = self.updated
+
+    def refill(self):
+        if self.rate is None:
+            return
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        """
+        Returns
+        -------
+        Seconds until `cost` tokens are available. 0 if they are available now.
+        """
+        if self.rate is None:
+            return max(0, self.paused_until - self.clock())
+
+        self.refill()
+        # Costs above capacity are let through once the bucket is full
+        needed = min(cost, self.capacity) - self.tokens
+        return max(0, needed / self.rate)
+
+    def take(self, cost):
+        if self.rate is None:
+            return
+        self.refill()
+        self.tokens -= cost
+
+    def pause(self, seconds):
+        """
+        Empties the bucket and holds it empty for `seconds`.
+        """
+        if self.rate is None:
+            self.paused_until = self.clock() + seconds
+            return
+        self.refill()
+        self.tokens = -seconds * self.rate
+
+class RequestScheduler:
+    """
+    Dispatches api calls from one queue per kind under a shared rate budget.
+
+    Queues are served in order of priority. Queues with the same priority
+    share the budget in proportion to their weights (stride scheduling on
+    cost / weight). A low-priority queue such as 'analysis' therefore only
+    gets the budget when no discovery calls are waiting, which keeps the
+    crawl frontier growing while still spending the whole rate limit.
+
+    run() keeps up to `workers` calls in flight on a thread pool, so
+    throughput is bounded by the rate budget rather than by the latency of
+    a single call. Dispatching and callbacks stay on the calling thread.
+    """
+
+    def __init__(self, call, rate=RATE_LIMIT, burst=None, settings=QUEUE_SETTINGS,
+                 workers=WORKERS, max_retries=MAX_RETRIES, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        Parameters
+        ----------
+        call: [function] called as call(kind, params, id_) for every request.
+            Should raise RateLimitError on a 429 response. ETL.api_call with
+            the token bound works here.
+
+        rate: [float] global budget in cost units per second. None for no
+            limit, e.g. when replaying fixtures.
+
+        burst: [float] optional bucket capacity. Defaults to one second of budget.
+
+        settings: [dict] priority, weight and cost per kind, like QUEUE_SETTINGS.
+
+        workers: [int] number of calls run() keeps in flight at once.
+
+        max_retries: [int] times a rate limited request is retried before it
+            is recorded in `errors` like any other failure.
+
+        clock, sleep: [function] time source and sleep function. Replaceable
+            for tests.
+        """
+        self.call = call
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.sleep = sleep
+        self.workers = workers
+        self.max_retries = max_retries
+        self.settings = {kind: dict(setting) for kind, setting in settings.items()}
+
+        self.queues = {kind: collections.deque() for kind in self.settings}
+        self.passes = {kind: 0.0 for kind in self.settings}
+        self.stats = {
+            'dispatched': {kind: 0 for kind in self.settings},
+            'failed': {kind: 0 for kind in self.settings},
+            'rate_limited': 0,
+            'waited': 0.0,
+        }
+
+        # (kind, params, id_, exception) for every call or callback that failed
+        self.errors = []
+
+    def submit(self, kind, params=None, id_=None, callback=None):
+        """
+        Queues an api call.
+
+        Parameters
+        ----------
+        kind: [str] one of the kinds in `settings`.
+
+        params, id_: passed on to `call`.
+
+        callback: [function] optional, called with the call's result. May
+            submit further requests.
+        """
+        if kind not in self.queues:
+            raise ValueError("Unknown kind {}. Use one of {}.".format(kind, list(self.queues)))
+
+        # A queue that was idle rejoins at the current pass of its priority
+        # level so it can't claim the budget it didn't use while empty
+        if not self.queues[kind]:
+            active = [self.passes[other] for other in self._active(self.settings[kind]['priority'])]
+            if active:
+                self.passes[kind] = max(self.passes[kind], min(active))
+
+        self.queues[kind].append((params, id_, callback, 0))
+
+    def depths(self):
+        """
+        Returns
+        -------
+        A dict of the number of waiting requests per kind.
+        """
+        return {kind: len(queue) for kind, queue in self.queues.items()}
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def next_kind(self):
+        """
+        Returns
+        -------
+        The kind whose request should be dispatched next, or None if every
+        queue is empty.
+        """
+        waiting = [kind for kind, queue in self.queues.items() if queue]
+        if not waiting:
+            return None
+
+        top = min(self.settings[kind]['priority'] for kind in waiting)
+        return min(self._active(top), key=lambda kind: self.passes[kind])
+
+    def step(self):
+        """
+        Waits for budget, then makes a single call and runs its callback.
+
+        Returns
+        -------
+        False if there was nothing to dispatch, else True.
+        """
+        dispatched = self._dispatch()
+        if dispatched is None:
+            return False
+
+        kind, request = dispatched
+        try:
+            result, error = self.call(kind, *request[:2]), None
+        except Exception as exception:
+            result, error = None, exception
+
+        self._complete(kind, request, result, error)
+        return True
+
+    def run(self, report=None, report_every=100):
+        """
+        Dispatches requests until every queue is empty and no call is in
+        flight. Failed calls and callbacks are collected in `errors` rather
+        than stopping the run.
+
+        Parameters
+        ----------
+        report: [function] optional, called with depths() every
+            `report_every` completed requests.
+        """
+        if self.workers <= 1:
+            count = 0
+            while self.step():
+                count += 1
+                if report is not None and count % report_every == 0:
+                    report(self.depths())
+            return
+
+        count = 0
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                # Keep the pool full while there is work and budget for it
+                while len(in_flight) < self.workers:
+                    dispatched = self._dispatch()
+                    if dispatched is None:
+                        break
+                    kind, request = dispatched
+                    future = pool.submit(self.call, kind, *request[:2])
+                    in_flight[future] = dispatched
+
+                if not in_flight:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, request = in_flight.pop(future)
+                    error = future.exception()
+                    result = None if error is not None else future.result()
+                    self._complete(kind, request, result, error)
+
+                    count += 1
+                    if report is not None and count % report_every == 0:
+                        report(self.depths())
+
+    def _dispatch(self):
+        """
+        Picks the next request and waits until the budget covers it.
+
+        Returns
+        -------
+        A tuple (kind, (params, id_, callback, retries)), or None if every
+        queue is empty.
+        """
+        kind = self.next_kind()
+        if kind is None:
+            return None
+
+        setting = self.settings[kind]
+        wait = self.bucket.wait_time(setting['cost'])
+        if wait > 0:
+            self.stats['waited'] += wait
+            self.sleep(wait)
+
+        request = self.queues[kind].popleft()
+        self.bucket.take(setting['cost'])
+        self.passes[kind] += setting['cost'] / setting['weight']
+        return kind, request
+
+    def _complete(self, kind, request, result, error):
+        """
+        Handles the outcome of a dispatched request.
+        """
+        params, id_, callback, retries = request
+
+        if isinstance(error, RateLimitError):
+            # Stop everyone, then put the request back at the head of its
+            # queue unless it has used up its retries
+            self.bucket.pause(error.retry_after)
+            self.stats['rate_limited'] += 1
+            if retries < self.max_retries:
+                setting = self.settings[kind]
+                self.passes[kind] -= setting['cost'] / setting['weight']
+                self.queues[kind].appendleft((params, id_, callback, retries + 1))
+                return
+
+        if error is None:
+            self.stats['dispatched'][kind] += 1
+            if callback is None:
+                return
+            try:
+                callback(result)
+                return
+            except Exception as exception:
+                error = exception
+
+        self.stats['failed'][kind] += 1
+        self.errors.append((kind, params, id_, error))
+
+    def _active(self, priority):
+        return [kind for kind, queue in self.queues.items()
+                if queue and self.settings[kind]['priority'] == priority]
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from src.analysis.similarity import SimilarityIndex
+
+@pytest.fixture
+def tracks():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(500, 12)) * rng.uniform(0.1, 100, size=12)
+    ids = np.array(['track_{}'.format(i) for i in range(len(X))])
+    return X, ids
+
+def brute_force(X, queries, k):
+    mean, scale = X.mean(axis=0), X.std(axis=0)
+    d = np.linalg.norm(
+        ((queries - mean) / scale)[:, None, :] - ((X - mean) / scale)[None, :, :],
+        axis=2)
+    return np.argsort(d, axis=1)[:, :k]
+
+class TestSimilarityIndex:
+    def test_exact_matches_brute_force(self, tracks):
+        X, ids = tracks
+        index = SimilarityIndex().fit(X, ids)
+        found, dists = index.query(X[:20], k=5)
+
+        assert (found == ids[brute_force(X, X[:20], 5)]).all()
+        assert (np.diff(dists, axis=1) >= 0).all()
+        assert np.allclose(dists[:, 0], 0, atol=1e-2)
+
+    def test_single_vector_query(self, tracks):
+        X, ids = tracks
+        found, dists = SimilarityIndex().fit(X, ids).query(X[3], k=3)
+        assert found.shape == (1, 3)
+        assert found[0, 0] == ids[3]
+
+    def test_partitioned_recall(self, tracks):
+        X, ids = tracks
+        index = SimilarityIndex('partitioned', n_partitions=10, n_probe=4).fit(X, ids)
+        found, _ = index.query(X[:50], k=5)
+
+        expected = ids[brute_force(X, X[:50], 5)]
+        recall = np.mean([len(set(f) & set(e)) / 5 for f, e in zip(found, expected)])
+        assert recall > 0.8
+
+    def test_partitioned_probe_all_is_exact(self, tracks):
+        X, ids = tracks
+        index = SimilarityIndex('partitioned', n_partitions=10, n_probe=10).fit(X, ids)
+        found, _ = index.query(X[:20], k=5)
+        assert (found == ids[brute_force(X, X[:20], 5)]).all()
+
+    def test_query_ids_excludes_self(self, tracks):
+        X, ids = tracks
+        index = SimilarityIndex().fit(X, ids)
+        found, dists = index.query_ids(ids[:10], k=4)
+
+        assert found.shape == (10, 4)
+        for track_id, neighbours in zip(ids[:10], found):
+            assert track_id not in neighbours
+        assert (found == ids[brute_force(X, X[:10], 5)[:, 1:]]).all()
+
+    @pytest.mark.parametrize('mode', ['exact', 'partitioned'])
+    def test_save_and_load(self, tracks, tmp_path, mode):
+        X, ids = tracks
+        index = SimilarityIndex(mode, n_partitions=10).fit(X, ids, features=list('abcdefghijkl'))
+        index.save(str(tmp_path))
+
+        loaded = SimilarityIndex.load(str(tmp_path))
+        assert isinstance(loaded.vectors_, np.memmap)
+        assert loaded.features == index.features
+        assert loaded.mode == mode
+
+        expected_ids, expected_dists = index.query(X[:10], k=5)
+        found_ids, found_dists = loaded.query(X[:10], k=5)
+        assert (found_ids == expected_ids).all()
+        assert np.allclose(found_dists, expected_dists)
+
+    def test_object_ids_save(self, tracks, tmp_path):
+        X, ids = tracks
+        object_ids = ids.astype(object)
+        index = SimilarityIndex().fit(X, object_ids)
+        index.save(str(tmp_path))
+
+        found, _ = SimilarityIndex.load(str(tmp_path)).query(X[:5], k=1)
+        assert found[:, 0].tolist() == object_ids[:5].tolist()
+
+    def test_partitioned_padding(self):
+        X = np.random.RandomState(0).rand(20, 3)
+        index = SimilarityIndex('partitioned', n_partitions=10, n_probe=1).fit(X)
+        found, dists = index.query_ids(np.arange(20), k=5)
+
+        assert found.shape == (20, 5)
+        for track_id, neighbours, d in zip(range(20), found, dists):
+            assert track_id not in neighbours
+            # Unfilled slots are marked missing, never a real id
+            assert (neighbours[np.isinf(d)] == -1).all()
+            assert (neighbours[~np.isinf(d)] >= 0).all()
+
+    def test_query_ids_object_and_unknown_ids(self, tracks):
+        X, ids = tracks
+        index = SimilarityIndex().fit(X, ids.astype(object))
+
+        found, _ = index.query_ids(ids[:3].astype(object), k=2)
+        assert found.shape == (3, 2)
+
+        with pytest.raises(ValueError, match='track_9999'):
+            index.query_ids(['track_1', 'track_9999'])
+
+    def test_k_larger_than_index(self, tracks):
+        X, ids = tracks
+        found, _ = SimilarityIndex().fit(X[:3], ids[:3]).query(X[:2], k=10)
+        assert found.shape == (2, 3)
+
+    def test_bad_input(self, tracks):
+        X, ids = tracks
+        with pytest.raises(ValueError):
+            SimilarityIndex('annoy')
+        with pytest.raises(ValueError):
+            SimilarityIndex().query(X[:1])
+        with pytest.raises(ValueError):
+            SimilarityIndex().fit(X, ids[:10])
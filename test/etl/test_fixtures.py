@@ -0,0 +1,140 @@
+import time
+
+import pytest
+from src.etl.fixtures import FixtureRecorder, FixtureReplayer, FixtureMissError
+from src.etl.scheduler import RequestScheduler, RateLimitError
+
+def fake_api(kind, params, id_):
+    return {'kind': kind, 'id': id_, 'params': params, 'items': [id_] * 3}
+
+class SlowTellFile:
+    def __init__(self, file):
+        self.file = file
+
+    def tell(self):
+        position = self.file.tell()
+        time.sleep(0.0005)
+        return position
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+@pytest.fixture
+def archive(tmp_path):
+    path = str(tmp_path / 'etl.fix')
+    with FixtureRecorder(fake_api, path) as recorder:
+        recorder('search', {'q': 'Aventura', 'type': 'artist'})
+        for n in range(100):
+            recorder('features', id_='track_{}'.format(n))
+    return path
+
+class TestFixtures:
+    def test_round_trip(self, archive):
+        with FixtureReplayer(archive) as replayer:
+            assert len(replayer) == 101
+            assert replayer('features', id_='track_42') == fake_api('features', None, 'track_42')
+
+            # Parameter order doesn't matter
+            assert replayer('search', {'type': 'artist', 'q': 'Aventura'})['kind'] == 'search'
+
+    def test_miss(self, archive):
+        with FixtureReplayer(archive) as replayer:
+            with pytest.raises(FixtureMissError):
+                replayer('analysis', id_='track_42')
+            assert ('features', None, 'track_1') in replayer
+            assert ('features', None, 'track_999') not in replayer
+
+    def test_latest_response_wins(self, tmp_path):
+        path = str(tmp_path / 'etl.fix')
+        with FixtureRecorder(fake_api, path) as recorder:
+            recorder.add('tracks', None, 't1', 'old')
+            recorder.add('tracks', None, 't1', 'new')
+        with FixtureReplayer(path) as replayer:
+            assert len(replayer) == 1
+            assert replayer('tracks', id_='t1') == 'new'
+
+    def test_not_an_archive(self, tmp_path):
+        path = tmp_path / 'junk.fix'
+        path.write_bytes(b'x' * 100)
+        with pytest.raises(ValueError):
+            FixtureReplayer(str(path))
+
+    def test_simulated_latency(self, archive):
+        sleeps = []
+        with FixtureReplayer(archive, latency=0.1, jitter=0.05, sleep=sleeps.append) as replayer:
+            for n in range(10):
+                replayer('features', id_='track_{}'.format(n))
+        assert len(sleeps) == 10
+        assert all(0.1 <= s <= 0.15 for s in sleeps)
+
+    def test_simulated_errors_are_deterministic(self, archive):
+        def outcomes():
+            result = []
+            with FixtureReplayer(archive, error_rate=0.3, seed=7) as replayer:
+                for n in range(50):
+                    try:
+                        replayer('features', id_='track_{}'.format(n))
+                        result.append(True)
+                    except RateLimitError:
+                        result.append(False)
+            return result
+
+        first = outcomes()
+        assert first == outcomes()
+        assert 0 < first.count(False) < 50
+
+    def test_concurrent_record(self, tmp_path):
+        path = str(tmp_path / 'etl.fix')
+        with FixtureRecorder(fake_api, path) as recorder:
+            # Yield between tell() and write() so unsynchronized threads
+            # would record the same offset
+            recorder.file = SlowTellFile(recorder.file)
+            scheduler = RequestScheduler(recorder, rate=None, workers=4)
+            for n in range(200):
+                scheduler.submit('analysis', id_=str(n))
+            scheduler.run()
+
+        assert scheduler.errors == []
+        with FixtureReplayer(path) as replayer:
+            assert len(replayer) == 200
+            for n in range(200):
+                assert replayer('analysis', id_=str(n)) == fake_api('analysis', None, str(n))
+
+    def test_concurrent_replay_is_deterministic(self, archive):
+        def replay():
+            results = []
+            # Real (short) sleeps let the worker threads finish in varying order
+            with FixtureReplayer(archive, jitter=0.002, error_rate=0.2, seed=1) as replayer:
+                scheduler = RequestScheduler(replayer, rate=None, workers=4,
+                                             sleep=lambda seconds: None)
+                for n in range(100):
+                    scheduler.submit('features', id_='track_{}'.format(n),
+                                     callback=lambda result: results.append(result['id']))
+                scheduler.run()
+            return scheduler.stats['rate_limited'], sorted(results)
+
+        first = replay()
+        assert first[0] > 0
+        assert len(first[1]) == 100
+        for _ in range(4):
+            assert replay() == first
+
+    def test_scheduled_replay(self, archive):
+        results = []
+        with FixtureReplayer(archive, error_rate=0.2) as replayer:
+            scheduler = RequestScheduler(replayer, rate=None, sleep=lambda seconds: None)
+            for n in range(100):
+                scheduler.submit('features', id_='track_{}'.format(n), callback=results.append)
+            scheduler.run()
+        assert sorted(result['id'] for result in results) == sorted(
+            'track_{}'.format(n) for n in range(100))
+        assert scheduler.stats['rate_limited'] > 0
+
+    def test_large_archive(self, tmp_path):
+        path = str(tmp_path / 'etl.fix')
+        with FixtureRecorder(fake_api, path) as recorder:
+            for n in range(20000):
+                recorder('analysis', id_=str(n))
+        with FixtureReplayer(path) as replayer:
+            for n in range(0, 20000, 997):
+                assert replayer('analysis', id_=str(n))['id'] == str(n)
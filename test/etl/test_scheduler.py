@@ -0,0 +1,198 @@
+import threading
+import pytest
+from src.etl.scheduler import RequestScheduler, RateLimitError, TokenBucket
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def make_scheduler(call, rate=10, workers=1, **kwargs):
+    clock = FakeClock()
+    scheduler = RequestScheduler(call, rate=rate, workers=workers, clock=clock,
+                                 sleep=clock.sleep, **kwargs)
+    return scheduler, clock
+
+class TestTokenBucket:
+    def test_wait_and_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+        bucket.take(2)
+        assert bucket.wait_time(1) == pytest.approx(0.5)
+        clock.sleep(1)
+        assert bucket.wait_time(2) == 0
+
+    def test_pause(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, clock=clock)
+        bucket.pause(3)
+        assert bucket.wait_time(1) == pytest.approx(3.5)
+
+    def test_unbounded(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=None, clock=clock)
+        bucket.take(1000)
+        assert bucket.wait_time(1000) == 0
+        bucket.pause(2)
+        assert bucket.wait_time(1) == pytest.approx(2)
+
+class TestRequestScheduler:
+    def test_discovery_before_analysis(self):
+        calls = []
+        scheduler, _ = make_scheduler(lambda kind, params, id_: calls.append(kind))
+        scheduler.submit('analysis', id_='t1')
+        scheduler.submit('features', id_='t1')
+        scheduler.submit('search', params={'q': 'Aventura'})
+        scheduler.run()
+        assert calls == ['search', 'features', 'analysis']
+
+    def test_callbacks_grow_frontier_first(self):
+        calls = []
+        scheduler, _ = make_scheduler(lambda kind, params, id_: calls.append((kind, id_)) or id_)
+
+        def on_album(album_id):
+            for n in range(2):
+                scheduler.submit('analysis', id_='{}-t{}'.format(album_id, n))
+
+        for album_id in ['a1', 'a2']:
+            scheduler.submit('album_tracks', id_=album_id, callback=on_album)
+        scheduler.run()
+
+        kinds = [kind for kind, _ in calls]
+        assert kinds == ['album_tracks'] * 2 + ['analysis'] * 4
+
+    def test_weights_share_budget(self):
+        settings = {'a': {'priority': 0, 'weight': 3, 'cost': 1},
+                    'b': {'priority': 0, 'weight': 1, 'cost': 1}}
+        calls = []
+        scheduler, _ = make_scheduler(lambda kind, params, id_: calls.append(kind),
+                                      settings=settings)
+        for _ in range(40):
+            scheduler.submit('a')
+            scheduler.submit('b')
+        for _ in range(40):
+            scheduler.step()
+        assert calls.count('a') == 30
+        assert calls.count('b') == 10
+
+    def test_rate_limit_respected(self):
+        scheduler, clock = make_scheduler(lambda kind, params, id_: None, rate=10)
+        for _ in range(30):
+            scheduler.submit('search')
+        scheduler.submit('analysis')
+        scheduler.run()
+        # 10 burst tokens, then 20 search + 3 analysis tokens at 10 per second
+        assert clock.now == pytest.approx(2.3)
+        assert scheduler.stats['dispatched']['search'] == 30
+
+    def test_retry_after_429(self):
+        responses = [RateLimitError(5), 'ok']
+        results = []
+
+        def call(kind, params, id_):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        scheduler, clock = make_scheduler(call)
+        scheduler.submit('tracks', id_='t1', callback=results.append)
+        scheduler.run()
+        assert results == ['ok']
+        assert scheduler.stats['rate_limited'] == 1
+        assert clock.now >= 5
+
+    def test_depths(self):
+        scheduler, _ = make_scheduler(lambda kind, params, id_: None)
+        scheduler.submit('search')
+        scheduler.submit('analysis')
+        scheduler.submit('analysis')
+        depths = scheduler.depths()
+        assert depths['search'] == 1
+        assert depths['analysis'] == 2
+        assert scheduler.pending() == 3
+
+        reports = []
+        scheduler.run(report=reports.append, report_every=1)
+        assert reports[-1]['analysis'] == 0
+
+    def test_errors_are_collected(self):
+        def call(kind, params, id_):
+            if id_ == 'bad':
+                raise IOError('404')
+            return {'error': {'status': 401}} if id_ == 'unauthorized' else {'sections': []}
+
+        results = []
+        scheduler, _ = make_scheduler(call)
+        for id_ in ['t1', 'bad', 'unauthorized', 't2']:
+            scheduler.submit('analysis', id_=id_,
+                             callback=lambda result: results.append(result['sections']))
+        scheduler.run()
+
+        assert results == [[], []]
+        assert [error[2] for error in scheduler.errors] == ['bad', 'unauthorized']
+        assert isinstance(scheduler.errors[1][3], KeyError)
+        assert scheduler.stats['failed']['analysis'] == 2
+        assert scheduler.stats['dispatched']['analysis'] == 3
+
+    def test_concurrent_calls(self):
+        workers = 4
+
+        # Every call waits until all workers are inside a call at once, so
+        # this only finishes if the calls overlap
+        barrier = threading.Barrier(workers, timeout=5)
+
+        def call(kind, params, id_):
+            barrier.wait()
+            return id_
+
+        results = []
+        scheduler = RequestScheduler(call, rate=None, workers=workers)
+        for n in range(20):
+            scheduler.submit('analysis', id_=n, callback=results.append)
+        scheduler.run()
+
+        assert sorted(results) == list(range(20))
+        assert scheduler.errors == []
+
+    def test_retries_exhausted(self):
+        def call(kind, params, id_):
+            raise RateLimitError(1)
+
+        scheduler, clock = make_scheduler(call, max_retries=3)
+        scheduler.submit('search', params={'q': 'Aventura'})
+        scheduler.submit('search', params={'q': 'Romeo Santos'})
+        scheduler.run()
+
+        assert scheduler.stats['rate_limited'] == 8
+        assert scheduler.stats['failed']['search'] == 2
+        assert [error[1]['q'] for error in scheduler.errors] == ['Aventura', 'Romeo Santos']
+        assert all(isinstance(error[3], RateLimitError) for error in scheduler.errors)
+
+    def test_concurrent_priorities(self):
+        calls = []
+        scheduler, _ = make_scheduler(lambda kind, params, id_: calls.append(kind), workers=4)
+
+        def on_album(result):
+            for n in range(3):
+                scheduler.submit('analysis', id_=n)
+
+        for n in range(8):
+            scheduler.submit('album_tracks', id_=n, callback=on_album)
+        scheduler.run()
+
+        assert scheduler.stats['dispatched']['album_tracks'] == 8
+        assert scheduler.stats['dispatched']['analysis'] == 24
+
+        # The first pool of calls is all discovery
+        assert calls.index('analysis') >= 4
+
+    def test_unknown_kind(self):
+        scheduler, _ = make_scheduler(lambda kind, params, id_: None)
+        with pytest.raises(ValueError):
+            scheduler.submit('playlists')
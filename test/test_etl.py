@@ -0,0 +1,59 @@
+import os
+import time
+import pytest
+
+# Import ETL.py in replay mode so it doesn't ask Spotify for a token
+os.environ['ETL_FIXTURE_MODE'] = 'replay'
+import ETL
+
+def fake_api_call(kind, token, params = None, id_ = None):
+    """
+    Stand-in for the Spotify api: 8 artists with 2 albums of 3 tracks each.
+    """
+    if kind == 'search':
+        return {'artists':{'items':[{'id':'artist-' + params['q']}]}}
+    if kind == 'albums':
+        return {'items':[{'id':f'{id_}-album{n}', 'artists':[{'name':id_[len('artist-'):]}]}
+                         for n in range(2)]}
+    if kind == 'album_tracks':
+        return {'items':[{'id':f'{id_}-track{n}'} for n in range(3)]}
+    if kind == 'features':
+        return {'id':id_, 'tempo':120.0, 'uri':'spotify:track:' + id_}
+    if kind == 'tracks':
+        return {'name':id_, 'album':{'name':'album', 'artists':[{'name':'artist'}],
+                                     'release_date':'2000'}}
+    if kind == 'analysis':
+        return {'sections':[{'duration':30.0}]}
+
+def live_api_call(kind, token, params = None, id_ = None):
+    raise AssertionError('Replay made a live api call')
+
+class TestCrawlReplay:
+    def test_record_then_replay_offline(self, tmp_path, monkeypatch):
+        path = str(tmp_path / 'etl.fix')
+        monkeypatch.setattr(ETL, 'FIXTURE_PATH', path)
+
+        # Record a crawl of the fake api without waiting on the rate limit
+        monkeypatch.setattr(ETL, 'api_call', fake_api_call)
+        monkeypatch.setattr(ETL, 'FIXTURE_MODE', 'record')
+        monkeypatch.setattr(ETL, 'RATE_LIMIT', None)
+        recorded = ETL.crawl_track_data(ETL.artists, 'token')
+        assert len(recorded) == 8 * 2 * 3
+
+        # Replay with the real rate limit in place. 176 calls at RATE_LIMIT
+        # would take over 15s, so finishing well under that shows the replay
+        # isn't throttled.
+        monkeypatch.setattr(ETL, 'api_call', live_api_call)
+        monkeypatch.setattr(ETL, 'FIXTURE_MODE', 'replay')
+        monkeypatch.setattr(ETL, 'RATE_LIMIT', 10)
+
+        start = time.monotonic()
+        replayed = ETL.crawl_track_data(ETL.artists, None)
+        elapsed = time.monotonic() - start
+
+        def by_id(rows):
+            return sorted(rows, key = lambda row: row['id'])
+
+        assert by_id(replayed) == by_id(recorded)
+        assert replayed[0]['sections'] == [{'duration':30.0}]
+        assert elapsed < 5